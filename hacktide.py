@@ -13,6 +13,17 @@ import subprocess
 import sys
 import shutil
 import atexit
+import unicodedata
+import statistics
+import threading
+import functools
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from streamlit import runtime
+
+# `python hacktide.py --build-pack FILE` builds a course pack without any UI.
+# Only honoured outside `streamlit run`, so the app never turns into a batch job.
+HEADLESS_BUILD = "--build-pack" in sys.argv and not runtime.exists()
 
 # =========================================================
 # 0. SAFE IMPORTS & CONFIG
@@ -23,11 +34,11 @@ try:
     import docx
     from pptx import Presentation
     import graphviz
+    import numpy as np
     
     # Video/Audio imports
     try:
         from PIL import Image, ImageDraw, ImageFont
-        import numpy as np
         PIL_AVAILABLE = True
     except ImportError:
         PIL_AVAILABLE = False
@@ -47,20 +58,53 @@ try:
     except ImportError:
         MOVIEPY_AVAILABLE = False
         st.warning("⚠️ MoviePy is not installed. Video generation will fail. Run: pip install moviepy")
+
+    # --- OPTIONAL LOCAL EMBEDDINGS FOR ANSWER GRADING ---
+    try:
+        from sentence_transformers import SentenceTransformer
+        EMBEDDINGS_AVAILABLE = True
+    except ImportError:
+        EMBEDDINGS_AVAILABLE = False  # Grader falls back to lexical scoring only
+
+    # --- OPTIONAL LOCAL CPU INFERENCE (llama.cpp) ---
+    try:
+        from llama_cpp import Llama
+        LLAMA_CPP_AVAILABLE = True
+    except ImportError:
+        LLAMA_CPP_AVAILABLE = False  # Only the Groq backend is available
+
+    # --- OPTIONAL LOCAL TOKENIZER FOR PROMPT BUDGETS ---
+    try:
+        import tiktoken
+        TIKTOKEN_AVAILABLE = True
+    except ImportError:
+        TIKTOKEN_AVAILABLE = False  # Falls back to a ~4 chars/token estimate
+
+    # --- OPTIONAL OCR FOR SCANNED PDFs (needs tesseract + poppler binaries) ---
+    try:
+        import pytesseract
+        from pdf2image import convert_from_bytes
+        OCR_AVAILABLE = True
+    except ImportError:
+        OCR_AVAILABLE = False  # Image-only pages come back empty
         
 except ImportError as e:
+    if HEADLESS_BUILD:
+        raise
     st.error(f"🚨 Required libraries missing! Error: {e}")
     st.info("""
     Run these commands in your terminal to fix everything:
     pip install streamlit groq PyPDF2 python-docx python-pptx graphviz
     pip install moviepy gtts pillow numpy
+    pip install pytesseract pdf2image   # optional: OCR for scanned PDFs
     """)
     st.stop()
 
-st.set_page_config(page_title="SyllabusQuest: Master Edition", page_icon="🧬", layout="wide")
+if not HEADLESS_BUILD:
+    st.set_page_config(page_title="SyllabusQuest: Master Edition", page_icon="🧬", layout="wide")
 
-# CSS STYLING
-st.markdown("""
+    # CSS STYLING
+    st.markdown("""
 <style>
     .stApp { background-color: #f8f9fa; color: #212529; }
     div.stButton > button {
@@ -88,21 +132,38 @@ st.markdown("""
         background: #000; padding: 15px; border-radius: 10px; margin: 10px 0;
     }
 </style>
-""", unsafe_allow_html=True)
+    """, unsafe_allow_html=True)
 
 # =========================================================
 # 1. API SETUP (USER INPUT ENABLED)
 # =========================================================
-with st.sidebar:
-    st.title("🔐 API Configuration")
-    user_api_key = st.text_input("Enter GROQ API Key", type="password", help="Get it from console.groq.com")
-    
-    if not user_api_key:
-        st.warning("⚠️ Enter API Key to start the System")
-        st.stop() # Stop execution until key is provided
+# Server-side paths come from the environment only, never from page visitors
+local_model_path = os.environ.get("LOCAL_MODEL_PATH", "")
+pack_path = os.environ.get("COURSE_PACK", "")
+local_ready = LLAMA_CPP_AVAILABLE and bool(local_model_path) and os.path.exists(local_model_path)
+pack_ready = bool(pack_path) and os.path.exists(os.path.join(pack_path, "pack.json"))
+
+if HEADLESS_BUILD:
+    user_api_key = os.environ.get("GROQ_API_KEY", "")
+else:
+    with st.sidebar:
+        st.title("🔐 API Configuration")
+        # The server key is a silent fallback, never a widget value sent to the browser
+        user_api_key = st.text_input("Enter GROQ API Key", type="password",
+                                     help="Get it from console.groq.com") or os.environ.get("GROQ_API_KEY", "")
+        if local_ready:
+            st.caption(f"🖥️ Local model: {os.path.basename(local_model_path)}")
+        if pack_ready:
+            st.caption(f"📦 Course pack: {os.path.basename(os.path.normpath(pack_path))}")
+        
+        if not user_api_key and not local_ready and not pack_ready:
+            st.warning("⚠️ Enter API Key (or set LOCAL_MODEL_PATH / COURSE_PACK on the server) to start the System")
+            st.stop() # Stop execution until a backend is available
+        if not user_api_key:
+            st.info("📴 Offline mode: AI features use the local model or the course pack")
 
 # Initialize Client with User Key
-client = Groq(api_key=user_api_key)
+client = Groq(api_key=user_api_key) if user_api_key else None
 
 # =========================================================
 # 2. VIDEO GENERATION MODULE
@@ -280,24 +341,127 @@ atexit.register(video_gen.cleanup)
 # =========================================================
 # 3. INTELLIGENT ENGINE (Optimized & Diagram Aware)
 # =========================================================
-def get_groq_response(prompt, context_text, expect_json=False, temperature=0.3):
-    """Core AI Engine. Handles Chunking, JSON enforcement, and Context."""
-    try:
-        # Reduced context size slightly to prevent timeouts/errors
-        safe_context = context_text[:15000] 
-        
-        full_prompt = f"""
-You are an academic assistant. Use ONLY the following context as the knowledge source.
-If something is not in the context, say you don't know and NEVER invent facts.
+# --- PROMPT BUILDER ---
+# Every request is [SYSTEM_PROMPT][CONTEXT][TASK]. The system prompt and the context
+# block are byte-identical across features, so the provider can cache that prefix;
+# only the short task suffix changes between lesson/game/exam/audit calls.
+SYSTEM_PROMPT = (
+    "You are a learning-aware academic tutor. Use ONLY the CONTEXT as your knowledge source; "
+    "if something is not in it, say you don't know and never invent facts. "
+    "Adapt to the learner's level. If a diagram would genuinely help, put a tag [Image of X] "
+    "(X = a specific, contextual query) right next to the relevant text. No generic illustrations."
+)
+JSON_SUFFIX = "\nReturn ONLY valid JSON matching the schema. No Markdown."
 
-CONTEXT (Uploaded syllabus / notes):
-{safe_context}
+# Compact schemas replace the verbose inline JSON examples
+PROMPT_SCHEMAS = {
+    "syllabus": '{"topics":[str]}',
+    "lesson": '{"title":str,"content":str,"real_world":str,"citation":str,'
+              '"quiz":[{"q":str,"opts":["A) ..","B) ..","C) ..","D) .."],"ans":"A|B|C|D","reason":str}]}',
+    "game": '{"q":str,"opts":["A) ..","B) ..","C) ..","D) .."],"ans":"A|B|C|D","exp":str}',
+    "exam": '{"questions":[{"id":int,"type":str,"text":str,"options":[str],"correct":str}]}',
+    "grading": '{"verdicts":[bool]}',
+    "diagram": '{"diagrams":{"<query>":{"direction":"TB|LR","nodes":[[id,label]],"edges":[[from_id,to_id,label]]}}}',
+}
 
-TASK:
-{prompt}
-"""
-        # Improved System Prompt for Diagrams
-        system_msg = """
+PROMPT_TASKS = {
+    "syllabus": "List the 5-8 main academic concepts/chapters of the context.\nSchema: {schema}",
+    "lesson": "Teach '{topic}'. Level: {level}. Style: {style}. Include exactly 5 distinct MCQs in quiz.\nSchema: {schema}",
+    "game": "Create 1 MCQ for '{topic}'.\nSchema: {schema}",
+    "exam": ("Create exactly 5 {q_type} questions. Difficulty: {difficulty}. MCQ: 4 distinct options. "
+             "Fill in the Blanks: mark the blank with '_______' and use options [].\nSchema: {schema}"),
+    "grading": ("Does each student answer mean the same as the expected answer? "
+                "Accept synonyms, plurals and minor typos.\n{listing}\nSchema: {schema} (same order)"),
+    "revision": ("Write a Markdown revision sheet: 5 key definitions, 3 common misconceptions, "
+                 "a formula/date cheat sheet and a golden summary."),
+    "chat": "Answer strictly from the context: {question}",
+    "video": "Explain '{topic}' for a video narration. Plain text only.",
+    "audit": "Audit the content for hallucinations or educational bias.",
+    "diagram": ("For each query, describe a diagram as a small graph (max 12 nodes, short labels), "
+                "keyed by the exact query text.\n{queries}\nSchema: {schema}"),
+}
+
+# The context block is cut to CONTEXT_TOKEN_BUDGET for every feature, so
+# [system][context] is byte-identical across calls. Per-feature budgets apply to
+# the task only: an oversized field (chat question, grading listing) is trimmed.
+CONTEXT_TOKEN_BUDGET = 3750  # ~15000 chars, the previous hard cut
+TASK_TOKEN_BUDGETS = {
+    "grading": 1200,   # Listing of every unsure answer on the paper
+    "diagram": 600,
+    "chat": 600,       # Free-text student question
+    "default": 300,
+}
+
+@st.cache_resource(show_spinner=False)
+def _load_tokenizer():
+    return tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=256)
+def count_tokens(text):
+    """Local token count (tiktoken if installed, else ~4 chars per token)."""
+    if TIKTOKEN_AVAILABLE:
+        return len(_load_tokenizer().encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ""
+    if TIKTOKEN_AVAILABLE:
+        enc = _load_tokenizer()
+        ids = enc.encode(text, disallowed_special=())
+        return text if len(ids) <= max_tokens else enc.decode(ids[:max_tokens])
+    return text[:max_tokens * 4]
+
+def build_task(feature, **fields):
+    """Fills the compact task template for a feature, within its task token budget."""
+    template = PROMPT_TASKS[feature]
+    schema = PROMPT_SCHEMAS.get(feature, "")
+    task = template.format(schema=schema, **fields)
+    over = count_tokens(task) - TASK_TOKEN_BUDGETS.get(feature, TASK_TOKEN_BUDGETS["default"])
+    if over > 0 and fields:
+        # Trim the longest field so the instructions and schema stay intact
+        key = max(fields, key=lambda k: len(str(fields[k])))
+        value = str(fields[key])
+        fields[key] = truncate_to_tokens(value, count_tokens(value) - over)
+        task = template.format(schema=schema, **fields)
+    return task
+
+CONTEXT_CACHE_SIZE = 8
+
+@st.cache_resource(show_spinner=False)
+def _context_cache():
+    return {}  # md5(document) -> context cut to CONTEXT_TOKEN_BUDGET
+
+def truncated_context(context_text):
+    """Context block for a document, tokenised once per document rather than per call.
+
+    Keyed by the document hash so the cache holds only the ~15k-char cut, never
+    the uploaded document itself.
+    """
+    if not context_text:
+        return ""
+    cache = _context_cache()
+    digest = hashlib.md5(context_text.encode("utf-8", "ignore")).hexdigest()
+    context = cache.get(digest)
+    if context is None:
+        context = truncate_to_tokens(context_text, CONTEXT_TOKEN_BUDGET)
+        if len(cache) >= CONTEXT_CACHE_SIZE:
+            cache.pop(next(iter(cache)), None)
+        cache[digest] = context
+    return context
+
+def build_messages(task, context_text, expect_json=False):
+    """Chat messages with the shared [system][context] prefix; only the task varies."""
+    if expect_json:
+        task += JSON_SUFFIX
+    context = truncated_context(context_text)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"CONTEXT:\n{context}\n\nTASK:\n{task}"}
+    ]
+
+# Pre-compaction prompts, kept only to measure savings in the Analytics tab
+_LEGACY_SYSTEM = """
 You are a Learning-Aware AI. Adapt to Beginner/Intermediate/Advanced levels.
 Assess if the user would understand the response better with a diagram.
 If yes, insert a diagram tag 
@@ -307,45 +471,304 @@ If yes, insert a diagram tag
 Place the tag immediately before or after relevant text.
 Do NOT use tags for generic illustrations.
 """
+_LEGACY_WRAPPER = """
+You are an academic assistant. Use ONLY the following context as the knowledge source.
+If something is not in the context, say you don't know and NEVER invent facts.
 
-        if expect_json:
-            full_prompt += "\n\nCRITICAL: Return ONLY valid JSON. No Markdown. No Intro."
-
-        completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": full_prompt}
-            ],
-            model="llama-3.1-8b-instant", # Using fast model to avoid rate limits
-            temperature=temperature,
-            response_format={"type": "json_object"} if expect_json else None
-        )
+CONTEXT (Uploaded syllabus / notes):
+{context}
 
-        response_text = completion.choices[0].message.content
+TASK:
+{task}
+"""
+_LEGACY_JSON = "\n\nCRITICAL: Return ONLY valid JSON. No Markdown. No Intro."
+_LEGACY_TASKS = {
+    "lesson": ("""
+                    Teach 'Topic' based ONLY on the context. 
+                    Level: Beginner. Style: Visual.
+                    
+                    REQUIREMENT: Generate EXACTLY 5 distinct Multiple Choice Questions (quiz).
+                    
+                    Output JSON: {
+                        "title": "Lesson Title", 
+                        "content": "Detailed explanation...", 
+                        "real_world": "Real world example...", 
+                        "citation": "Source...", 
+                        "quiz": [
+                            {"q":"Question 1","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"A","reason":"Explanation for Q1"},
+                            {"q":"Question 2","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"B","reason":"Explanation for Q2"},
+                            {"q":"Question 3","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"C","reason":"Explanation for Q3"},
+                            {"q":"Question 4","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"D","reason":"Explanation for Q4"},
+                            {"q":"Question 5","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"A","reason":"Explanation for Q5"}
+                        ]
+                    }
+                    """, True),
+    "game": ("""Create 1 MCQ for 'Topic'. JSON: {"q":"...","opts":["A)...","B)...","C)...","D)..."],"ans":"A","exp":"..."}""", True),
+    "exam": ("""
+                Create a strict JSON object with exactly 5 MCQ questions based on the text. Difficulty: Easy.
+                
+                JSON Structure must be EXACTLY:
+                {
+                  "questions": [
+                    {
+                      "id": 1,
+                      "type": "MCQ",
+                      "text": "Question text here (For Fill in Blanks, use '_______' for the blank)",
+                      "options": ["A) ...", "B) ...", "C) ...", "D) ..."] (ONLY IF MCQ),
+                      "correct": "Answer here"
+                    }
+                  ]
+                }
 
-        if expect_json:
-            try:
-                # Robust extraction: find first { and last }
-                clean_text = re.sub(r"```json|```", "", response_text).strip()
-                start = clean_text.find('{')
-                end = clean_text.rfind('}') + 1
-                if start != -1 and end != -1:
-                    return json.loads(clean_text[start:end])
-                else:
-                    return json.loads(clean_text) # Try raw
-            except Exception as json_err:
-                print(f"JSON Parsing Error: {json_err}")
-                return None
+                IMPORTANT:
+                1. If type is MCQ, 'options' must be a list of 4 distinct strings.
+                2. If type is Fill in the Blanks, 'options' must be an empty list [].
+                3. Ensure valid JSON syntax (close all brackets/braces).
+                """, True),
+    "revision": ("""
+                Based ONLY on the provided context, create a revision sheet with:
+                1. 5 Key Definitions
+                2. 3 Common Misconceptions
+                3. A Formula/Date Cheat Sheet
+                4. A Golden Summary
+                Format in clean Markdown.
+                """, False),
+    "audit": ("Audit the provided content for any hallucinations or educational bias.", False),
+}
 
-        return response_text
-    except Exception as e:
+def prompt_savings_report(context_text):
+    """Input tokens per feature, pre-compaction prompts vs the prompt builder.
+
+    Template tokens (system prompt, wrapper, task, JSON instruction) and context
+    tokens are reported separately, so compaction is not confused with truncation.
+    """
+    sample = {"topic": "Topic", "level": "Beginner", "style": "Visual", "q_type": "MCQ", "difficulty": "Easy"}
+    context_before = count_tokens(context_text[:15000])
+    context_after = count_tokens(truncated_context(context_text))
+    rows = []
+    for feature, (legacy_task, expect_json) in _LEGACY_TASKS.items():
+        legacy_user = _LEGACY_WRAPPER.format(context="", task=legacy_task) + (_LEGACY_JSON if expect_json else "")
+        template_before = count_tokens(_LEGACY_SYSTEM) + count_tokens(legacy_user)
+        messages = build_messages(build_task(feature, **sample), "", expect_json)
+        template_after = sum(count_tokens(m["content"]) for m in messages)
+        rows.append({
+            "Feature": feature,
+            "Template before": template_before,
+            "Template after": template_after,
+            "Template saved": f"{(template_before - template_after) / template_before:.0%}",
+            "Context before": context_before,
+            "Context after": context_after,
+        })
+    return rows
+
+class BackendUnavailable(Exception):
+    """Raised when a backend cannot serve a request right now (no key/model, rate limit)."""
+
+class GroqBackend:
+    """Hosted inference through the Groq API."""
+    name = "groq"
+
+    def __init__(self, client, model="llama-3.1-8b-instant"):
+        self.client = client
+        self.model = model
+
+    def available(self):
+        return self.client is not None
+
+    def complete(self, messages, temperature, expect_json, max_tokens):
+        try:
+            completion = self.client.chat.completions.create(
+                messages=messages,
+                model=self.model, # Using fast model to avoid rate limits
+                temperature=temperature,
+                max_tokens=max_tokens,
+                response_format={"type": "json_object"} if expect_json else None
+            )
+        except Exception as e:
+            if "429" in str(e):
+                raise BackendUnavailable("Rate limit reached") from e
+            raise
+        usage = getattr(completion, "usage", None)
+        return (completion.choices[0].message.content,
+                getattr(usage, "completion_tokens", 0) or 0,
+                getattr(usage, "prompt_tokens", 0) or 0)
+
+@st.cache_resource(show_spinner=False)
+def _load_local_model(model_path, n_ctx):
+    """One model per process plus the lock that serialises calls into it.
+
+    A Llama instance is not thread-safe, and Streamlit sessions (and the course
+    pack worker pool) call it from parallel threads.
+    """
+    llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=os.cpu_count(), verbose=False)
+    return llm, threading.Lock()
+
+class LocalLlamaBackend:
+    """CPU inference on a quantised GGUF model through llama.cpp bindings."""
+    name = "local"
+
+    def __init__(self, model_path, n_ctx=8192):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+
+    def available(self):
+        return LLAMA_CPP_AVAILABLE and bool(self.model_path) and os.path.exists(self.model_path)
+
+    def complete(self, messages, temperature, expect_json, max_tokens):
+        llm, lock = _load_local_model(self.model_path, self.n_ctx)
+        with lock:
+            out = llm.create_chat_completion(
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                response_format={"type": "json_object"} if expect_json else None
+            )
+        usage = out.get("usage", {})
+        return out["choices"][0]["message"]["content"], usage.get("completion_tokens", 0), usage.get("prompt_tokens", 0)
+
+BACKENDS = {
+    "groq": GroqBackend(client),
+    "local": LocalLlamaBackend(local_model_path),
+}
+
+# Backend preference per feature. The first available backend is tried first; the
+# rest are fallbacks (rate limits, missing key, offline).
+BACKEND_POLICY = {
+    "game": ["local", "groq"],      # Short cards: cheap enough for CPU
+    "grading": ["local", "groq"],
+    "syllabus": ["groq", "local"],
+    "lesson": ["groq", "local"],    # Long structured output: prefer Groq
+    "exam": ["groq", "local"],
+    "revision": ["groq", "local"],
+    "chat": ["groq", "local"],
+    "video": ["groq", "local"],
+    "audit": ["groq", "local"],
+    "diagram": ["groq", "local"],
+    "default": ["groq", "local"],
+}
+
+# Output token cap per feature. Sized so the structured payloads (a lesson with
+# 5 MCQs, a 5-question paper) fit, which keeps local JSON from being cut off.
+MAX_OUTPUT_TOKENS = {
+    "lesson": 3000,
+    "revision": 2000,
+    "exam": 1500,
+    "chat": 1500,
+    "audit": 1500,
+    "video": 800,
+    "diagram": 2000,   # Every uncached diagram of a lesson/answer in one call
+    "game": 400,
+    "syllabus": 300,
+    "grading": 200,
+    "default": 1500,
+}
+
+class InvalidJSONResponse(ValueError):
+    """Raised when a backend answers an expect_json request with unparseable JSON."""
+
+def _parse_json_response(response_text):
+    # Robust extraction: find first { and last }
+    clean_text = re.sub(r"```json|```", "", response_text or "").strip()
+    start = clean_text.find('{')
+    end = clean_text.rfind('}') + 1
+    try:
+        if start != -1 and end != -1:
+            return json.loads(clean_text[start:end])
+        return json.loads(clean_text) # Try raw
+    except Exception as json_err:
+        raise InvalidJSONResponse(str(json_err)) from json_err
+
+@st.cache_resource(show_spinner=False)
+def _backend_stats():
+    """Process-wide call stats (survive reruns, shared across sessions)."""
+    return {"lock": threading.Lock(), "calls": {}}
+
+def _record_backend_call(name, seconds, tokens, ok, prompt_tokens=0):
+    stats = _backend_stats()
+    with stats["lock"]:
+        row = stats["calls"].setdefault(name, {"latencies": [], "tokens": 0, "prompt_tokens": 0, "failures": 0})
+        if ok:
+            row["latencies"].append(seconds)
+            row["tokens"] += tokens
+            row["prompt_tokens"] += prompt_tokens
+        else:
+            row["failures"] += 1
+    meter = getattr(_usage_meter, "usage", None)
+    if ok and meter is not None:
+        used = meter.setdefault(name, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        used["calls"] += 1
+        used["prompt_tokens"] += prompt_tokens
+        used["completion_tokens"] += tokens
+
+_usage_meter = threading.local()
+
+def metered(fn):
+    """Runs fn() and returns (result, {backend: usage}) for the AI calls it made on this thread."""
+    previous = getattr(_usage_meter, "usage", None)
+    _usage_meter.usage = {}
+    try:
+        return fn(), _usage_meter.usage
+    finally:
+        _usage_meter.usage = previous
+
+def backend_report():
+    """Per-backend throughput and latency, for sizing the CPU fleet."""
+    stats = _backend_stats()
+    rows = []
+    with stats["lock"]:
+        for name, row in stats["calls"].items():
+            lat = sorted(row["latencies"])
+            busy = sum(lat)
+            rows.append({
+                "Backend": name,
+                "Calls": len(lat),
+                "Failures": row["failures"],
+                "Avg latency (s)": round(busy / len(lat), 2) if lat else None,
+                "p95 latency (s)": round(lat[int(0.95 * (len(lat) - 1))], 2) if lat else None,
+                "Tokens/s": round(row["tokens"] / busy, 1) if busy else None,
+            })
+    return rows
+
+def get_groq_response(prompt, context_text, expect_json=False, temperature=0.3, feature="default"):
+    """Core AI Engine. Handles Chunking, JSON enforcement, Context and backend routing."""
+    messages = build_messages(prompt, context_text, expect_json)
+
+    max_tokens = MAX_OUTPUT_TOKENS.get(feature, MAX_OUTPUT_TOKENS["default"])
+
+    result = None
+    last_error = None
+    for name in BACKEND_POLICY.get(feature, BACKEND_POLICY["default"]):
+        backend = BACKENDS[name]
+        if not backend.available():
+            continue
+        start = time.perf_counter()
+        try:
+            response_text, tokens, prompt_tokens = backend.complete(messages, temperature, expect_json, max_tokens)
+            if response_text is None:
+                raise ValueError("empty response")
+            # Truncated/malformed JSON counts as a failure so the next backend gets a try
+            result = _parse_json_response(response_text) if expect_json else response_text
+            _record_backend_call(name, time.perf_counter() - start, tokens, ok=True, prompt_tokens=prompt_tokens)
+            break
+        except Exception as e:
+            _record_backend_call(name, time.perf_counter() - start, 0, ok=False)
+            print(f"Backend '{name}' failed for {feature}: {e}")
+            last_error = e
+
+    if result is None:
         # VISIBLE ERROR MESSAGE FOR DEBUGGING
-        if "429" in str(e):
+        if isinstance(last_error, InvalidJSONResponse):
+             print(f"JSON Parsing Error: {last_error}")  # Callers show their own message
+        elif last_error is None:
+             st.error("🚨 No AI backend available. Enter a GROQ API Key or a local model path.")
+        elif isinstance(last_error, BackendUnavailable):
              st.error("🚨 Rate Limit Reached. Please wait a moment before trying again.")
         else:
-             st.error(f"🚨 AI Error: {e}")
+             st.error(f"🚨 AI Error: {last_error}")
         return None
 
+    return result
+
 # =========================================================
 # 4. HELPERS
 # =========================================================
@@ -359,15 +782,261 @@ def get_topic_image(topic):
     if any(x in t for x in ["code", "computer"]): return base + "photo-1555066931-4365d14bab8c?w=800"
     return base + "photo-1456513080510-7bf3a84b82f8?w=800"
 
+def write_atomic(path, data):
+    """Writes str/bytes via a uniquely named temp file in the same folder, then renames.
+
+    Concurrent writers of the same path each get their own temp file, so a
+    half-written or interleaved file is never visible. Raises OSError on failure.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    mode = "wb" if isinstance(data, bytes) else "w"
+    with tempfile.NamedTemporaryFile(mode, dir=path.parent, prefix=path.name + ".", suffix=".tmp", delete=False) as tmp:
+        tmp.write(data)
+    try:
+        os.replace(tmp.name, path)
+    except OSError:
+        os.unlink(tmp.name)
+        raise
+
+# --- PDF EXTRACTION (text layer + OCR for image-only pages) ---
+PAGE_CACHE_DIR = Path(os.environ.get("PAGE_CACHE_DIR", Path(__file__).parent / ".cache" / "pages"))
+OCR_MIN_TEXT_CHARS = 25   # Pages with less extractable text than this are OCR candidates
+OCR_DPI = 300
+OCR_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+HEADING_SIZE_RATIO = 1.25  # Font/line height vs page median that marks a heading
+
+@st.cache_resource(show_spinner=False)
+def _extraction_stats():
+    """Process-wide log of PDF extractions (survives reruns)."""
+    return {"lock": threading.Lock(), "runs": []}
+
+def _page_has_images(page):
+    try:
+        xobjects = page["/Resources"].get("/XObject")
+        if not xobjects:
+            return False
+        return any(x.get_object().get("/Subtype") in ("/Image", "/Form") for x in xobjects.get_object().values())
+    except Exception:
+        return True  # When unsure, let OCR decide
+
+def _single_page_pdf(page):
+    """The page as a standalone PDF: stable hash input and OCR input in one."""
+    writer = PyPDF2.PdfWriter()
+    writer.add_page(page)
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+def _mark_headings(lines, sizes):
+    """Prefixes lines whose size stands out from the page median with '## '."""
+    if not sizes:
+        return lines
+    # Lower median: with one heading and one body line the body size is the baseline
+    median = statistics.median_low(sizes)
+    return [
+        f"## {line}" if size >= median * HEADING_SIZE_RATIO and len(line.split()) <= 12 else line
+        for line, size in zip(lines, sizes)
+    ]
+
+def _text_page(page):
+    """Text layer in PyPDF2 order, with large-font lines marked as headings."""
+    runs = []
+    def visit(text, cm, tm, font_dict, font_size):
+        if text.strip():
+            runs.append((text.strip(), (font_size or 0) * (abs(tm[3]) or 1)))
+    try:
+        text = page.extract_text(visitor_text=visit) or ""
+    except TypeError:  # Older PyPDF2 without visitor support
+        return page.extract_text() or ""
+    run_sizes = {t: size for t, size in runs}
+    lines = text.splitlines()
+    sizes = [run_sizes.get(line.strip(), 0) for line in lines]
+    known = [sz for sz in sizes if sz]
+    if not known:
+        return text
+    median = statistics.median_low(known)
+    return "\n".join(_mark_headings(lines, [sz or median for sz in sizes]))
+
+def _ocr_page(page_pdf):
+    """OCR one page. Runs in a worker thread; pdftoppm and tesseract are subprocesses."""
+    image = convert_from_bytes(page_pdf, dpi=OCR_DPI)[0]
+    data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
+    lines, heights, paragraphs = {}, {}, []
+    for i, word in enumerate(data["text"]):
+        if not word.strip() or float(data["conf"][i]) < 0:
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(word)
+        heights.setdefault(key, []).append(data["height"][i])
+    # Tesseract numbers blocks/paragraphs/lines in reading order (handles columns)
+    ordered = list(lines)
+    texts = [" ".join(lines[k]) for k in ordered]
+    sizes = [statistics.median_low(heights[k]) for k in ordered]
+    marked = _mark_headings(texts, sizes)
+    for i, key in enumerate(ordered):
+        if i and key[:2] != ordered[i - 1][:2]:
+            paragraphs.append("")  # Blank line between paragraphs
+        paragraphs.append(marked[i])
+    return "\n".join(paragraphs)
+
+def _ocr_cached(page_pdf, digest, cache_dir, fallback=""):
+    """OCR text for a page, cached by digest; the short text-layer text if OCR fails."""
+    try:
+        text = _ocr_page(page_pdf)
+    except Exception as e:  # e.g. tesseract/poppler binaries missing
+        print(f"OCR failed: {e}")
+        return fallback
+    try:
+        write_atomic(cache_dir / f"{digest}.json", json.dumps({"text": text}))
+    except OSError as e:  # Cache is best-effort
+        print(f"OCR cache write failed: {e}")
+    return text
+
+def _extract_pdf(file_bytes, cache_dir):
+    """Returns (text, stats) for a PDF, using cache_dir as the OCR page cache."""
+    start = time.perf_counter()
+    pdf = PyPDF2.PdfReader(io.BytesIO(file_bytes))
+    texts = [""] * len(pdf.pages)
+    pending = {}  # digest -> (page_pdf, page indices, text-layer fallback)
+    cached = skipped = 0
+    for i, page in enumerate(pdf.pages):
+        text = _text_page(page)
+        texts[i] = text
+        if len(text.strip()) >= OCR_MIN_TEXT_CHARS or not _page_has_images(page):
+            continue
+        if not OCR_AVAILABLE:
+            skipped += 1  # Image-only page we cannot read
+            continue
+        page_pdf = _single_page_pdf(page)
+        digest = hashlib.sha256(page_pdf).hexdigest()
+        try:
+            texts[i] = json.loads((cache_dir / f"{digest}.json").read_text())["text"]
+            cached += 1
+        except (OSError, ValueError, KeyError):
+            # Identical pages (repeated cover, blank scan) are OCR'd once
+            pending.setdefault(digest, (page_pdf, [], text))[1].append(i)
+    text_seconds = time.perf_counter() - start
+
+    ocr_pages = sum(len(indices) for _, indices, _ in pending.values())
+    if pending:
+        with ThreadPoolExecutor(max_workers=OCR_WORKERS) as pool:
+            futures = {digest: pool.submit(_ocr_cached, page_pdf, digest, cache_dir, fallback)
+                       for digest, (page_pdf, _, fallback) in pending.items()}
+            for digest, future in futures.items():
+                for i in pending[digest][1]:
+                    texts[i] = future.result()
+    total = time.perf_counter() - start
+
+    stats = {
+        "Pages": len(texts),
+        "Text layer": len(texts) - ocr_pages - cached - skipped,
+        "OCR (new)": ocr_pages,
+        "OCR (cached)": cached,
+        "Skipped (no OCR)": skipped,
+        "Seconds": round(total, 2),
+        "Pages/s": round(len(texts) / total, 1) if total else None,
+        "OCR pages/s": round(ocr_pages / (total - text_seconds), 2) if pending else None,
+    }
+    return "\n\n".join(t for t in texts if t.strip()), stats
+
+def extract_pdf_text(file_bytes):
+    """Extracts a PDF page by page, sending only image-only pages to OCR.
+
+    OCR results are cached by page hash, so re-uploading an edited handout only
+    OCRs the pages that changed.
+    """
+    text, run = _extract_pdf(file_bytes, PAGE_CACHE_DIR)
+    stats = _extraction_stats()
+    with stats["lock"]:
+        stats["runs"].append(run)
+    return text
+
+def _sample_text_pdf(pages):
+    """Minimal PDF with a real text layer: one (heading, body) pair per page."""
+    objs = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages)))}] /Count {len(pages)} >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, (heading, body) in enumerate(pages):
+        stream = f"BT /F1 22 Tf 72 740 Td ({heading}) Tj ET\nBT /F1 11 Tf 72 700 Td ({body}) Tj ET"
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                    f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objs.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    out, offsets = "%PDF-1.4\n", []
+    for n, body in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode("latin-1")
+
+def _sample_scanned_pdf(pages):
+    """Image-only pages (no text layer), like a scanned handout."""
+    try:
+        font_head, font_body = ImageFont.load_default(size=48), ImageFont.load_default(size=24)
+    except TypeError:  # Pillow < 10.1
+        font_head = font_body = ImageFont.load_default()
+    images = []
+    for heading, body in pages:
+        img = Image.new("RGB", (1275, 1650), color=(255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        draw.text((150, 150), heading, fill=(0, 0, 0), font=font_head)
+        draw.text((150, 260), body, fill=(0, 0, 0), font=font_body)
+        images.append(img)
+    buf = io.BytesIO()
+    images[0].save(buf, "PDF", resolution=150, save_all=True, append_images=images[1:])
+    return buf.getvalue()
+
+def sample_mixed_pdf(pages=6):
+    """Alternating text-layer and scanned pages, each with distinct content."""
+    content = [(f"Chapter {i + 1}", f"Cells divide by mitosis; sample paragraph number {i + 1} for extraction.")
+               for i in range(pages)]
+    text_pdf = PyPDF2.PdfReader(io.BytesIO(_sample_text_pdf(content[0::2])))
+    sources = [text_pdf.pages]
+    if PIL_AVAILABLE and content[1::2]:
+        sources.append(PyPDF2.PdfReader(io.BytesIO(_sample_scanned_pdf(content[1::2]))).pages)
+    writer = PyPDF2.PdfWriter()
+    for i in range(pages):
+        group = sources[i % len(sources)]
+        index = i // len(sources)
+        if index < len(group):
+            writer.add_page(group[index])
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+def benchmark_pdf_extraction(file_bytes=None, pages=6):
+    """Pages/s on a mixed text + scanned PDF, cold (empty page cache) then warm."""
+    file_bytes = file_bytes or sample_mixed_pdf(pages)
+    rows = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for label in ("Cold (empty page cache)", "Warm (page cache)"):
+            _, stats = _extract_pdf(file_bytes, Path(cache_dir))
+            rows.append({"Run": label, **stats})
+    return rows
+
+def extract_headings(text):
+    """Headings marked by the PDF extractor, for topic sectioning."""
+    return [line[3:].strip() for line in (text or "").splitlines() if line.startswith("## ") and line[3:].strip()]
+
+def syllabus_task(text):
+    """Syllabus prompt, guided by the document's own headings when it has them."""
+    task = build_task("syllabus")
+    headings = extract_headings(text)
+    if headings:
+        task += "\nDocument headings, in order: " + "; ".join(headings[:40])
+    return task
+
 @st.cache_data(show_spinner=False)
 def extract_file_content(uploaded_file):
     """Extracts text from PDF, DOCX, PPTX, TXT."""
     text_content = ""
     try:
         if uploaded_file.name.endswith(".pdf"):
-            pdf = PyPDF2.PdfReader(uploaded_file)
-            for page in pdf.pages:
-                text_content += page.extract_text() or ""
+            text_content = extract_pdf_text(uploaded_file.getvalue())
         elif uploaded_file.name.endswith(".docx"):
             doc = docx.Document(uploaded_file)
             text_content = "\n".join([para.text for para in doc.paragraphs])
@@ -383,6 +1052,652 @@ def extract_file_content(uploaded_file):
         return None
     return text_content
 
+# =========================================================
+# 4B. LOCAL ANSWER GRADER (Fill in the Blanks)
+# =========================================================
+# Scores at or above ACCEPT are marked correct locally, scores below REJECT are
+# marked wrong locally, and only the band in between is sent to the LLM.
+GRADE_ACCEPT_THRESHOLD = 0.85
+GRADE_REJECT_THRESHOLD = 0.55
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+_ARTICLES = {"a", "an", "the"}
+
+def _singularize(word):
+    """Very small plural stripper: 'cells' -> 'cell', 'mitochondria' untouched."""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ses", "xes", "ches", "shes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is", "ys")):
+        return word[:-1]
+    return word
+
+def normalize_answer(text):
+    """Lowercase, strip accents/punctuation/articles and singularize each token."""
+    text = unicodedata.normalize("NFKD", str(text or "")).encode("ascii", "ignore").decode()
+    text = re.sub(r"['’]s\b", "", text.lower())
+    tokens = re.sub(r"[^a-z0-9\s]", " ", text).split()
+    return " ".join(_singularize(t) for t in tokens if t not in _ARTICLES)
+
+def _batch_edit_ratio(left, right):
+    """Levenshtein similarity for every (left[i], right[i]) pair in one DP pass.
+
+    The DP runs over character positions while each step is a numpy operation
+    across the whole paper, so grading 5 or 50 blanks costs about the same.
+    """
+    n = len(left)
+    if n == 0:
+        return np.zeros(0)
+    la = np.array([len(s) for s in left])
+    lb = np.array([len(s) for s in right])
+    max_a, max_b = max(la.max(), 1), max(lb.max(), 1)
+    a = np.full((n, max_a), -1, dtype=np.int32)
+    b = np.full((n, max_b), -2, dtype=np.int32)
+    for i, (sa, sb) in enumerate(zip(left, right)):
+        a[i, :len(sa)] = [ord(c) for c in sa]
+        b[i, :len(sb)] = [ord(c) for c in sb]
+
+    dist = lb.astype(np.float64)  # Distance when the left string is empty
+    prev = np.tile(np.arange(max_b + 1), (n, 1))
+    rows = np.arange(n)
+    for i in range(1, max_a + 1):
+        cur = np.empty_like(prev)
+        cur[:, 0] = i
+        for j in range(1, max_b + 1):
+            cost = (a[:, i - 1] != b[:, j - 1]).astype(np.int32)
+            cur[:, j] = np.minimum(np.minimum(prev[:, j] + 1, cur[:, j - 1] + 1), prev[:, j - 1] + cost)
+        done = la == i
+        dist[done] = cur[rows[done], lb[done]]
+        prev = cur
+
+    longest = np.maximum(np.maximum(la, lb), 1)
+    return 1.0 - dist / longest
+
+def _one_edit_kind(a, b):
+    """'insert' if a and b differ by one inserted/deleted char, 'substitute' for one
+    replaced char, None if they are further apart (or equal)."""
+    if a == b or abs(len(a) - len(b)) > 1:
+        return None
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if a[i + (len(a) == len(b)):] != b[i + 1:]:
+        return None
+    return "substitute" if len(a) == len(b) else "insert"
+
+def _tokens_close(given, expected, vocabulary=frozenset()):
+    """Local acceptance guard: same tokens, or each changed token only a dropped/extra letter.
+
+    Whole-string similarity alone accepts opposites such as 'anaerobic' vs
+    'aerobic' (0.9), and a one-letter substitution is just as often another
+    real term ('adsorption' vs 'absorption', 'isotone' vs 'isotope'), so those
+    go to the escalation band. So does any edited token that appears as a word
+    in the document itself.
+    """
+    g, e = given.split(), expected.split()
+    if set(g) == set(e):
+        return True
+    if len(g) != len(e):
+        return False
+    return all(a == b or (_one_edit_kind(a, b) == "insert" and a not in vocabulary) for a, b in zip(g, e))
+
+def _batch_token_overlap(left, right):
+    """Jaccard overlap of normalized token sets for each pair."""
+    scores = []
+    for sa, sb in zip(left, right):
+        ta, tb = set(sa.split()), set(sb.split())
+        scores.append(len(ta & tb) / len(ta | tb) if ta | tb else 1.0)
+    return np.array(scores)
+
+@st.cache_resource(show_spinner=False)
+def _load_embedding_model():
+    return SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
+
+def _batch_embedding_similarity(left, right):
+    """Cosine similarity from a small local embedding model (None if unavailable)."""
+    if not EMBEDDINGS_AVAILABLE or not left:
+        return None
+    try:
+        model = _load_embedding_model()
+        vecs = model.encode(list(left) + list(right), normalize_embeddings=True, batch_size=64)
+        return np.sum(vecs[:len(left)] * vecs[len(left):], axis=1)
+    except Exception as e:
+        print(f"Embedding grading disabled: {e}")
+        return None
+
+def _llm_grade(pairs, context_text):
+    """Single batched LLM call for the answers the local scorer is unsure about."""
+    listing = "\n".join(
+        f"{i + 1}. Question: {q} | Expected: {exp} | Student: {ans}" for i, (q, exp, ans) in enumerate(pairs)
+    )
+    prompt = build_task("grading", listing=listing)
+    data = get_groq_response(prompt, context_text, expect_json=True, temperature=0.0, feature="grading")
+    verdicts = data.get("verdicts") if isinstance(data, dict) else None
+    if not isinstance(verdicts, list) or len(verdicts) != len(pairs):
+        return None
+    return [_parse_verdict(v) for v in verdicts]
+
+def _parse_verdict(value):
+    """Strict True/False for a model verdict; None (unresolved) for anything unrecognised."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return {"true": True, "yes": True, "correct": True,
+                "false": False, "no": False, "incorrect": False}.get(value.strip().lower())
+    return None
+
+def grade_blank_answers(questions, answers, context_text="", use_embeddings=True, escalate=True):
+    """Grades a full Fill-in-the-Blanks paper locally, escalating only unsure items.
+
+    Returns one dict per question: {"id", "correct", "score", "method"}.
+    """
+    expected = [normalize_answer(q.get("correct", "")) for q in questions]
+    given = [normalize_answer(answers.get(q["id"], "")) for q in questions]
+    vocabulary = frozenset(normalize_answer(context_text).split())
+
+    scores = np.maximum(_batch_edit_ratio(given, expected), _batch_token_overlap(given, expected))
+    method = "lexical"
+    if use_embeddings:
+        sem = _batch_embedding_similarity(given, expected)
+        if sem is not None:
+            scores = np.maximum(scores, sem)
+            method = "embedding"
+
+    results = []
+    for q, g, e, score in zip(questions, given, expected, scores):
+        score = float(score)
+        if not g:
+            score, verdict = 0.0, False
+        elif g == e:
+            score, verdict = 1.0, True
+        elif re.search(r"\d", e) or re.search(r"\d", g):
+            # Numbers, dates and formulas must match exactly after normalization
+            verdict = (re.findall(r"\d+", g) == re.findall(r"\d+", e)
+                       and score >= GRADE_ACCEPT_THRESHOLD and _tokens_close(g, e, vocabulary))
+        elif score >= GRADE_ACCEPT_THRESHOLD:
+            # High similarity is only trusted for typos; any other token change is escalated
+            verdict = True if _tokens_close(g, e, vocabulary) else None
+        elif score < GRADE_REJECT_THRESHOLD:
+            verdict = False
+        else:
+            verdict = None  # Unsure -> escalate
+        results.append({"id": q["id"], "correct": verdict, "score": score, "method": method if verdict is not None else "llm"})
+
+    unsure = [i for i, r in enumerate(results) if r["correct"] is None]
+    if unsure:
+        verdicts = None
+        if escalate:
+            pairs = [(questions[i].get("text", ""), questions[i].get("correct", ""), answers.get(questions[i]["id"], "")) for i in unsure]
+            verdicts = _llm_grade(pairs, context_text)
+        for k, i in enumerate(unsure):
+            if verdicts is not None and verdicts[k] is not None:
+                results[i]["correct"] = verdicts[k]
+            else:
+                # No usable LLM verdict -> stay strict, as exact-match grading was
+                results[i]["correct"] = False
+                results[i]["method"] = "unresolved"
+    return results
+
+# Labelled (student, expected, is_correct) pairs used for the accuracy-vs-latency report
+GRADER_SAMPLES = [
+    ("mitochondria", "Mitochondria", True),
+    ("mitosis", "meiosis", False),
+    ("chloroplasts", "chloroplast", True),
+    ("photosynthesis", "photosynthesis", True),
+    ("photosynthesys", "photosynthesis", True),
+    ("respiration", "photosynthesis", False),
+    ("Newtons second law", "Newton's second law", True),
+    ("newton's third law", "Newton's second law", False),
+    ("1945", "1945", True),
+    ("1944", "1945", False),
+    ("H2O", "h2o", True),
+    ("CO2", "O2", False),
+    ("ribosomes", "ribosome", True),
+    ("nucleus", "nucleolus", False),
+    ("kinetic energy", "energy of motion", True),
+    ("potential energy", "kinetic energy", False),
+    ("deoxyribonucleic acid", "DNA", True),
+    ("the cell membrane", "cell membrane", True),
+    ("cell wall", "cell membrane", False),
+    ("evaporation", "evaporation process", True),
+    # Hard negatives: a prefix flips the meaning but keeps string similarity high
+    ("anaerobic respiration", "aerobic respiration", False),
+    ("irreversible reaction", "reversible reaction", False),
+    ("endothermic reaction", "exothermic reaction", False),
+    ("unsaturated fat", "saturated fat", False),
+    ("hyperthyroidism", "hypothyroidism", False),
+    # One-letter substitutions: usually another real term, sometimes just a typo
+    ("adsorption", "absorption", False),
+    ("isotone", "isotope", False),
+    ("hydrolisis", "hydrolysis", True),
+]
+
+def benchmark_grader(samples=None):
+    """Accuracy and latency of each grading mode on the labelled samples (no LLM calls)."""
+    samples = samples or GRADER_SAMPLES
+    questions = [{"id": i, "correct": exp} for i, (_, exp, _) in enumerate(samples)]
+    answers = {i: ans for i, (ans, _, _) in enumerate(samples)}
+    labels = [label for _, _, label in samples]
+
+    modes = [("Exact match (legacy)", None), ("Local lexical", False)]
+    if EMBEDDINGS_AVAILABLE:
+        modes.append(("Local lexical + embeddings", True))
+
+    report = []
+    for name, use_embeddings in modes:
+        start = time.perf_counter()
+        if use_embeddings is None:
+            verdicts = [answers[q["id"]].strip().lower() == q["correct"].strip().lower() for q in questions]
+            unsure = 0
+        else:
+            graded = grade_blank_answers(questions, answers, use_embeddings=use_embeddings, escalate=False)
+            verdicts = [r["correct"] for r in graded]
+            unsure = sum(r["method"] == "unresolved" for r in graded)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        accuracy = sum(v == l for v, l in zip(verdicts, labels)) / len(labels)
+        report.append({
+            "Mode": name,
+            "Accuracy": f"{accuracy:.0%}",
+            "Latency (ms / paper)": round(elapsed_ms, 2),
+            "Would escalate": f"{unsure}/{len(labels)}",
+        })
+    return report
+
+# =========================================================
+# 4C. DIAGRAM PIPELINE ([Image of X] -> Graphviz)
+# =========================================================
+DIAGRAM_TAG_RE = re.compile(r"\[Image of ([^\]]+)\]")
+DIAGRAM_CACHE_DIR = Path(os.environ.get("DIAGRAM_CACHE_DIR", Path(__file__).parent / ".cache" / "diagrams"))
+DIAGRAM_WORKERS = 4
+
+def extract_diagram_tags(text):
+    """Unique diagram queries in order of appearance."""
+    seen = []
+    for query in DIAGRAM_TAG_RE.findall(text or ""):
+        query = query.strip()
+        if query and query not in seen:
+            seen.append(query)
+    return seen
+
+def strip_diagram_tags(text):
+    return DIAGRAM_TAG_RE.sub("", text or "").strip()
+
+def spec_to_dot(spec):
+    """Builds DOT source from the compact {"direction","nodes","edges"} spec."""
+    g = graphviz.Digraph(graph_attr={"rankdir": "LR" if spec.get("direction") == "LR" else "TB", "bgcolor": "transparent"},
+                         node_attr={"shape": "box", "style": "rounded,filled", "fillcolor": "#e7f1ff", "fontname": "Helvetica"},
+                         edge_attr={"fontname": "Helvetica", "fontsize": "10"})
+    for node in spec.get("nodes", []):
+        if isinstance(node, (list, tuple)) and node:
+            g.node(str(node[0]), str(node[-1]))
+    for edge in spec.get("edges", []):
+        if isinstance(edge, (list, tuple)) and len(edge) >= 2:
+            g.edge(str(edge[0]), str(edge[1]), label=str(edge[2]) if len(edge) > 2 and edge[2] else None)
+    return g.source
+
+def _spec_path(query, context_text):
+    """Spec cache file, per document and query."""
+    doc_key = hashlib.md5((context_text or "").encode()).hexdigest()[:12]
+    return DIAGRAM_CACHE_DIR / "specs" / f"{doc_key}_{hashlib.md5(query.lower().encode()).hexdigest()[:12]}.json"
+
+def _fetch_diagram_specs(queries, context_text):
+    """One structured request for all uncached queries, returning {query: spec}."""
+    listing = "\n".join(f"- {q}" for q in queries)
+    data = get_groq_response(build_task("diagram", queries=listing), context_text,
+                             expect_json=True, temperature=0.0, feature="diagram")
+    diagrams = (data or {}).get("diagrams")
+    if not isinstance(diagrams, dict):
+        return {}
+    by_key = {str(k).strip().lower(): v for k, v in diagrams.items()}
+    specs = {}
+    for query in queries:
+        spec = by_key.get(query.lower())
+        if isinstance(spec, dict) and spec.get("nodes"):
+            specs[query] = spec
+    return specs
+
+def _diagram_specs(queries, context_text):
+    """Specs for every query: disk cache first, then a single batched LLM call."""
+    specs, missing = {}, []
+    for query in queries:
+        try:
+            specs[query] = json.loads(_spec_path(query, context_text).read_text())
+        except (OSError, ValueError):  # Not cached yet (or unreadable) -> fetch it
+            missing.append(query)
+    if missing:
+        for query, spec in _fetch_diagram_specs(missing, context_text).items():
+            specs[query] = spec
+            try:
+                write_atomic(_spec_path(query, context_text), json.dumps(spec))
+            except OSError as e:  # Cache is best-effort; the spec is still used this time
+                print(f"Diagram spec cache write failed: {e}")
+    return specs
+
+def render_dot(dot_source):
+    """Renders DOT to SVG and PNG, keyed by DOT hash. Returns the PNG path (None on failure)."""
+    digest = hashlib.sha256(dot_source.encode()).hexdigest()[:16]
+    png_path = DIAGRAM_CACHE_DIR / f"{digest}.png"
+    if png_path.exists():
+        return str(png_path)
+    try:
+        src = graphviz.Source(dot_source)
+        write_atomic(DIAGRAM_CACHE_DIR / f"{digest}.svg", src.pipe(format="svg"))
+        write_atomic(png_path, src.pipe(format="png"))  # A half-written PNG is never served
+        return str(png_path)
+    except Exception as e:  # e.g. graphviz.ExecutableNotFound when `dot` is not installed
+        print(f"Diagram render failed: {e}")
+        return None
+
+def prepare_diagrams(text, context_text):
+    """Resolves every [Image of X] tag in text to a rendered PNG path (or None).
+
+    Specs come from the disk cache, with all uncached queries sent in one compact
+    LLM request; rendering runs in a thread pool (each render is a `dot`
+    subprocess) and is cached by DOT hash.
+    """
+    queries = extract_diagram_tags(text)
+    if not queries:
+        return {}
+    DIAGRAM_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    dots = {query: spec_to_dot(spec) for query, spec in _diagram_specs(queries, context_text).items()}
+    with ThreadPoolExecutor(max_workers=DIAGRAM_WORKERS) as pool:
+        rendered = dict(zip(dots, pool.map(render_dot, dots.values())))
+    return {query: rendered.get(query) for query in queries}
+
+def render_with_diagrams(text, diagrams):
+    """Writes text, replacing each diagram tag with its rendered image."""
+    parts = DIAGRAM_TAG_RE.split(text or "")
+    # re.split with one group alternates [text, query, text, query, ...]
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if part.strip():
+                st.write(part.strip())
+        else:
+            path = (diagrams or {}).get(part.strip())
+            if path:
+                st.image(path, caption=part.strip(), use_container_width=True)
+            else:
+                st.caption(f"📊 Diagram: {part.strip()}")
+
+# =========================================================
+# 4D. COURSE PACK EXPORT (headless batch build)
+# =========================================================
+# Usage: python hacktide.py --build-pack notes.pdf --out packs/biology --workers 4
+PACK_LEVEL = "Beginner"   # Lessons are pre-built for the app's default Level/Style
+PACK_STYLE = "Visual"
+PACK_CARDS_PER_TOPIC = 5
+PACK_EXAM_TYPES = ["MCQ", "Fill in the Blanks"]
+PACK_EXAM_DIFFICULTIES = ["Easy", "Medium", "Hard"]
+# USD per 1M (input, output) tokens; local CPU inference is free per call
+BACKEND_PRICING = {"groq": (0.05, 0.08), "local": (0.0, 0.0)}
+
+def _slug(text):
+    base = re.sub(r"[^a-z0-9]+", "-", str(text).lower()).strip("-")[:40]
+    return f"{base}-{hashlib.md5(str(text).encode()).hexdigest()[:6]}"
+
+def _add_usage(total, usage):
+    for name, used in usage.items():
+        row = total.setdefault(name, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        for k in row:
+            row[k] += used.get(k, 0)
+    return total
+
+def _usage_cost(usage):
+    cost = 0.0
+    for name, used in usage.items():
+        in_price, out_price = BACKEND_PRICING.get(name, (0.0, 0.0))
+        cost += (used["prompt_tokens"] * in_price + used["completion_tokens"] * out_price) / 1e6
+    return cost
+
+class PackCheckpoints:
+    """Per-unit JSON checkpoints so an interrupted build resumes where it stopped.
+
+    Checkpoints belong to one source document (by SHA-256); pointing the build at
+    a folder made from other bytes starts it over. Each checkpoint keeps the time
+    and token usage it cost, so the report covers the whole course, not only the
+    last run.
+    """
+
+    def __init__(self, out_dir, source_hash):
+        self.out_dir = Path(out_dir)
+        self.root = self.out_dir / "checkpoints"
+        marker = self.root / "source.sha256"
+        if self.root.exists() and (not marker.exists() or marker.read_text().strip() != source_hash):
+            for stale in (self.root, self.out_dir / "diagrams", self.out_dir / "videos"):
+                shutil.rmtree(stale, ignore_errors=True)
+            (self.out_dir / "pack.json").unlink(missing_ok=True)  # Never serve the old document's pack
+        self.root.mkdir(parents=True, exist_ok=True)
+        marker.write_text(source_hash)
+        self.lock = threading.Lock()
+        self.stage_seconds = {}
+        self.usage = {}
+        self.failed_seconds = 0.0   # Spend on units that did not finish in this run
+        self.failed_usage = {}
+
+    def _path(self, stage, key):
+        return self.root / stage / f"{hashlib.md5(str(key).encode()).hexdigest()[:16]}.json"
+
+    def _account(self, stage, seconds, usage, failed=False):
+        with self.lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            _add_usage(self.usage, usage)
+            if failed:
+                self.failed_seconds += seconds
+                _add_usage(self.failed_usage, usage)
+
+    def run(self, stage, key, fn):
+        """Returns the checkpointed result for (stage, key), computing it with fn() if missing."""
+        path = self._path(stage, key)
+        if path.exists():
+            saved = json.loads(path.read_text())
+            self._account(stage, saved.get("seconds", 0.0), saved.get("usage", {}))
+            return saved["data"]
+        start = time.perf_counter()
+        data, usage = metered(fn)
+        seconds = time.perf_counter() - start
+        self._account(stage, seconds, usage, failed=data is None)
+        if data is not None:
+            write_atomic(path, json.dumps({"stage": stage, "key": key, "data": data, "seconds": seconds, "usage": usage}))
+        return data
+
+    def record_run(self, wall_seconds):
+        """Appends this run to runs.json and returns every run so far."""
+        runs_path = self.root / "runs.json"
+        runs = json.loads(runs_path.read_text()) if runs_path.exists() else []
+        runs.append({"wall_seconds": wall_seconds, "failed_seconds": self.failed_seconds, "failed_usage": self.failed_usage})
+        write_atomic(runs_path, json.dumps(runs))
+        return runs
+
+class _LocalUpload(io.BytesIO):
+    """Makes a file on disk look like a Streamlit upload for extract_file_content."""
+
+    def __init__(self, path):
+        super().__init__(Path(path).read_bytes())
+        self.name = Path(path).name
+
+def _pack_lesson(topic, text, out_dir):
+    data = get_groq_response(build_task("lesson", topic=topic, level=PACK_LEVEL, style=PACK_STYLE),
+                             text, expect_json=True, feature="lesson")
+    if not data:
+        return None
+    diagrams = {}
+    for query, path in prepare_diagrams(str(data.get("content", "")), text).items():
+        if path:
+            rel = f"diagrams/{Path(path).name}"
+            shutil.copy(path, out_dir / rel)
+            diagrams[query] = rel
+    return {"lesson": data, "diagrams": diagrams}
+
+def _pack_cards(topic, text, checkpoints):
+    """Card bank for one topic. Each card is its own checkpoint, so a resume only fills gaps."""
+    cards = []
+    for n in range(PACK_CARDS_PER_TOPIC):
+        def make_card():
+            for _ in range(3):  # Retry duplicates
+                card = get_groq_response(build_task("game", topic=topic), text, expect_json=True, temperature=0.8, feature="game")
+                if card and card.get("q") and all(card.get("q") != c.get("q") for c in cards):
+                    return card
+            return None
+        card = checkpoints.run("game", f"{topic}#{n}", make_card)
+        if card:
+            cards.append(card)
+    return cards
+
+def _pack_exam(q_type, difficulty, text):
+    data = get_groq_response(build_task("exam", q_type=q_type, difficulty=difficulty), text, expect_json=True, feature="exam")
+    return (data or {}).get("questions") or None
+
+def _pack_video(topic, text, out_dir):
+    content = get_groq_response(build_task("video", topic=topic), text, feature="video")
+    if not content:
+        return None
+    content = strip_diagram_tags(content)
+    audio_path = video_gen.create_audio_from_text(content, topic)
+    frames = video_gen.create_video_frames(topic, content)
+    if not (audio_path and frames):
+        return None
+    rel = f"videos/{_slug(topic)}.mp4"
+    video_path = video_gen.render_final_video(frames, audio_path, Path(rel).name)
+    if not video_path:
+        return None
+    shutil.move(video_path, out_dir / rel)
+    return rel
+
+def build_course_pack(source_path, out_dir, workers=4, videos=True):
+    """Runs the whole pipeline for one document and writes <out_dir>/pack.json.
+
+    Every unit of work (syllabus, each lesson, card set, exam paper, video, the
+    revision sheet) is checkpointed, so re-running after a crash or rate limit
+    only redoes what is missing. Returns the build report.
+    """
+    wall_start = time.perf_counter()
+    out_dir = Path(out_dir)
+    source_path = Path(source_path)
+    checkpoints = PackCheckpoints(out_dir, hashlib.sha256(source_path.read_bytes()).hexdigest())
+    for sub in ("diagrams", "videos"):
+        (out_dir / sub).mkdir(parents=True, exist_ok=True)
+
+    text = checkpoints.run("extract", source_path.name, lambda: extract_file_content(_LocalUpload(source_path)) or None)
+    if not text:
+        raise ValueError(f"Could not read file: {source_path}")
+    syllabus = checkpoints.run("syllabus", "topics", lambda: (
+        get_groq_response(syllabus_task(text), text, expect_json=True, feature="syllabus") or {}).get("topics"))
+    if not syllabus:
+        # Every per-topic unit hangs off the syllabus, so there is nothing sound to build
+        checkpoints.record_run(time.perf_counter() - wall_start)
+        raise ValueError("Syllabus generation failed; nothing was built (re-run to retry)")
+    print(f"📖 {len(syllabus)} topics: {', '.join(syllabus)}")
+
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for topic in syllabus:
+            jobs[("lessons", topic)] = pool.submit(checkpoints.run, "lesson", topic, lambda t=topic: _pack_lesson(t, text, out_dir))
+            jobs[("game_cards", topic)] = pool.submit(_pack_cards, topic, text, checkpoints)
+            if videos:
+                jobs[("videos", topic)] = pool.submit(checkpoints.run, "video", topic, lambda t=topic: _pack_video(t, text, out_dir))
+        for q_type in PACK_EXAM_TYPES:
+            for diff in PACK_EXAM_DIFFICULTIES:
+                key = f"{q_type}|{diff}"
+                jobs[("exam_papers", key)] = pool.submit(checkpoints.run, "exam", key, lambda q=q_type, d=diff: _pack_exam(q, d, text))
+        jobs[("revision", None)] = pool.submit(checkpoints.run, "revision", "notes", lambda: get_groq_response(
+            build_task("revision"), text, feature="revision"))
+
+    pack = {
+        "version": 1, "source_name": source_path.name, "source_text": text, "syllabus": syllabus,
+        "level": PACK_LEVEL, "style": PACK_STYLE,
+        "lessons": {}, "game_cards": {}, "exam_papers": {}, "videos": {}, "revision": None,
+    }
+    failed = []
+    for (section, key), future in jobs.items():
+        try:
+            data = future.result()
+        except Exception as e:
+            print(f"❌ {section} [{key}]: {e}")
+            data = None
+        if section == "game_cards" and len(data or []) < PACK_CARDS_PER_TOPIC:
+            failed.append(f"{section}:{key} ({len(data or [])}/{PACK_CARDS_PER_TOPIC})")
+            if data:
+                pack[section][key] = data  # Keep the partial bank; a resume fills the rest
+        elif data is None:
+            failed.append(f"{section}:{key}" if key else section)
+        elif key is None:
+            pack[section] = data
+        else:
+            pack[section][key] = data
+
+    # Course totals: every finished unit (from its checkpoint) plus the spend of
+    # units that failed in any run, so resumed builds still report the full cost.
+    runs = checkpoints.record_run(time.perf_counter() - wall_start)
+    usage = dict(checkpoints.usage)
+    for run in runs[:-1]:
+        _add_usage(usage, run["failed_usage"])
+    compute = sum(checkpoints.stage_seconds.values()) + sum(run["failed_seconds"] for run in runs[:-1])
+    pack["build"] = {
+        "wall_seconds": round(runs[-1]["wall_seconds"], 1),
+        "wall_seconds_total": round(sum(run["wall_seconds"] for run in runs), 1),
+        "runs": len(runs),
+        "compute_seconds_total": round(compute, 1),
+        "stage_seconds": {k: round(v, 1) for k, v in checkpoints.stage_seconds.items()},
+        "workers": workers,
+        "usage": usage,
+        "cost_usd": round(_usage_cost(usage), 4),
+        "failed": failed,
+    }
+    write_atomic(out_dir / "pack.json", json.dumps(pack, indent=1))
+    return pack["build"]
+
+def load_course_pack(pack_dir):
+    """Loads a built pack, resolving its asset paths against the pack folder."""
+    pack_dir = Path(pack_dir)
+    pack_file = pack_dir / "pack.json"
+    if not pack_file.exists():
+        return None
+    pack = json.loads(pack_file.read_text())
+    for entry in pack.get("lessons", {}).values():
+        entry["diagrams"] = {q: str(pack_dir / rel) for q, rel in entry.get("diagrams", {}).items()}
+    pack["videos"] = {t: str(pack_dir / rel) for t, rel in pack.get("videos", {}).items()}
+    return pack
+
+def next_game_card(topic, context_text, pack=None):
+    """Serves an unused pre-built card from the course pack, else asks the AI."""
+    cards = (pack or {}).get("game_cards", {}).get(topic)
+    if cards:
+        return cards.pop(0)
+    return get_groq_response(build_task("game", topic=topic), context_text, expect_json=True, feature="game")
+
+def run_build_pack_cli(argv):
+    parser = argparse.ArgumentParser(prog="python hacktide.py", description="Pre-build a whole-course pack offline.")
+    parser.add_argument("--build-pack", dest="source", required=True, metavar="FILE", help="PDF/DOCX/PPTX/TXT to build from")
+    parser.add_argument("--out", help="Output folder (default: packs/<file name>)")
+    parser.add_argument("--workers", type=int, default=4, help="Max concurrent AI/render jobs")
+    parser.add_argument("--no-videos", action="store_true", help="Skip video rendering")
+    args = parser.parse_args(argv)
+
+    if not any(b.available() for b in BACKENDS.values()):
+        print("🚨 No AI backend: set GROQ_API_KEY or LOCAL_MODEL_PATH.")
+        return 1
+    out_dir = args.out or os.path.join("packs", _slug(Path(args.source).stem))
+    try:
+        report = build_course_pack(args.source, out_dir, workers=args.workers, videos=not args.no_videos)
+    except ValueError as e:
+        print(f"🚨 {e}")
+        return 1
+    print(f"📦 Pack written to {out_dir}")
+    print(f"⏱️ Wall time: {report['wall_seconds']}s this run, {report['wall_seconds_total']}s over {report['runs']} run(s)")
+    print(f"💰 Course cost: ${report['cost_usd']} · {report['compute_seconds_total']}s of job time")
+    for name, u in report["usage"].items():
+        print(f"   {name}: {u['calls']} calls, {u['prompt_tokens']} in / {u['completion_tokens']} out tokens")
+    if report["failed"]:
+        print(f"⚠️ Incomplete (re-run to resume): {', '.join(report['failed'])}")
+        return 2
+    return 0
+
+if HEADLESS_BUILD:
+    sys.exit(run_build_pack_cli(sys.argv[1:]))
+
 # =========================================================
 # 5. SESSION STATE INIT
 # =========================================================
@@ -398,6 +1713,9 @@ if 'exam_paper' not in st.session_state: st.session_state.exam_paper = None
 if 'exam_answers' not in st.session_state: st.session_state.exam_answers = {}
 if 'chat_history' not in st.session_state: st.session_state.chat_history = []
 if 'card_revealed' not in st.session_state: st.session_state.card_revealed = False
+if 'lesson_diagrams' not in st.session_state: st.session_state.lesson_diagrams = {}
+if 'course_pack' not in st.session_state: st.session_state.course_pack = None
+if 'served_exam_papers' not in st.session_state: st.session_state.served_exam_papers = set()
 
 # New Video States
 if 'generated_videos' not in st.session_state: st.session_state.generated_videos = {} # Store topic:path
@@ -407,6 +1725,16 @@ if 'generated_videos' not in st.session_state: st.session_state.generated_videos
 # =========================================================
 with st.sidebar:
     st.title("📂 Knowledge Base")
+    if pack_ready and st.session_state.course_pack is None:
+        pack = load_course_pack(pack_path)
+        if pack:
+            st.session_state.course_pack = pack
+            st.session_state.file_text = pack["source_text"]
+            st.session_state.syllabus = pack["syllabus"]
+            st.session_state.generated_videos.update(pack["videos"])
+    if st.session_state.course_pack:
+        st.success(f"📦 Course pack: {st.session_state.course_pack['source_name']}")
+
     uploaded_file = st.file_uploader("Upload File", type=['pdf', 'docx', 'pptx', 'txt'])
 
     if uploaded_file and not st.session_state.file_text:
@@ -414,11 +1742,8 @@ with st.sidebar:
             text = extract_file_content(uploaded_file)
             if text:
                 st.session_state.file_text = text
-                syl_prompt = (
-                    "From the context, list the top 5-8 main academic concepts/chapters ONLY.\n"
-                    "JSON format: {\"topics\": [\"Topic 1\", \"Topic 2\", ...]}"
-                )
-                syl_data = get_groq_response(syl_prompt, text, expect_json=True)
+                syl_prompt = syllabus_task(text)
+                syl_data = get_groq_response(syl_prompt, text, expect_json=True, feature="syllabus")
 
                 if syl_data and 'topics' in syl_data:
                     st.session_state.syllabus = syl_data['topics']
@@ -427,6 +1752,8 @@ with st.sidebar:
                     st.session_state.syllabus = ["General Content"]
             else:
                 st.error("❌ Could not read file.")
+                if uploaded_file.name.endswith(".pdf") and not OCR_AVAILABLE:
+                    st.info("Scanned PDF? Install OCR support: pip install pytesseract pdf2image (plus tesseract and poppler).")
 
     # NAVIGATION
     if st.session_state.syllabus:
@@ -467,42 +1794,37 @@ if st.session_state.file_text:
             lvl = st.radio("Level", ["Beginner", "Intermediate", "Advanced"], key="l1")
             style = st.radio("Style", ["Visual", "Real-World", "Academic"], key="s1")
 
+            pack = st.session_state.course_pack
+            packed = None
+            if pack and (lvl, style) == (pack["level"], pack["style"]):
+                packed = pack["lessons"].get(current_topic)
+
             if st.button("🚀 Teach This"):
-                with st.spinner("Generating..."):
-                    prompt = f"""
-                    Teach '{current_topic}' based ONLY on the context. 
-                    Level: {lvl}. Style: {style}.
-                    
-                    REQUIREMENT: Generate EXACTLY 5 distinct Multiple Choice Questions (quiz).
-                    
-                    Output JSON: {{
-                        "title": "Lesson Title", 
-                        "content": "Detailed explanation...", 
-                        "real_world": "Real world example...", 
-                        "citation": "Source...", 
-                        "quiz": [
-                            {{"q":"Question 1","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"A","reason":"Explanation for Q1"}},
-                            {{"q":"Question 2","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"B","reason":"Explanation for Q2"}},
-                            {{"q":"Question 3","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"C","reason":"Explanation for Q3"}},
-                            {{"q":"Question 4","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"D","reason":"Explanation for Q4"}},
-                            {{"q":"Question 5","opts":["A) ...","B) ...","C) ...", "D) ..."],"ans":"A","reason":"Explanation for Q5"}}
-                        ]
-                    }}
-                    """
-                    data = get_groq_response(prompt, st.session_state.file_text, expect_json=True)
-                    if data: 
-                        st.session_state.lesson_content = data
-                    else:
-                        st.error("⚠️ AI returned no content. Please check API Key or File Content.")
+                if packed:
+                    # Pre-built by the course pack: no API call
+                    st.session_state.lesson_content = packed["lesson"]
+                    st.session_state.lesson_diagrams = packed["diagrams"]
+                else:
+                    with st.spinner("Generating..."):
+                        prompt = build_task("lesson", topic=current_topic, level=lvl, style=style)
+                        data = get_groq_response(prompt, st.session_state.file_text, expect_json=True, feature="lesson")
+                        if data: 
+                            st.session_state.lesson_content = data
+                            st.session_state.lesson_diagrams = prepare_diagrams(
+                                str(data.get('content', '')), st.session_state.file_text
+                            )
+                        else:
+                            st.error("⚠️ AI returned no content. Please check API Key or File Content.")
 
         with c2:
             if st.session_state.lesson_content:
                 d = st.session_state.lesson_content
-                st.image(get_topic_image(d.get('title', current_topic)), use_container_width=True)
+                if not st.session_state.lesson_diagrams:
+                    st.image(get_topic_image(d.get('title', current_topic)), use_container_width=True)
                 st.markdown(f"## {d.get('title')}")
-                st.write(d.get('content'))
+                render_with_diagrams(str(d.get('content', '')), st.session_state.lesson_diagrams)
                 if d.get('real_world'):
-                    st.info(f"🌍 **Real World:** {d['real_world']}")
+                    st.info(f"🌍 **Real World:** {strip_diagram_tags(str(d['real_world']))}")
                 
                 st.markdown("---")
                 st.subheader(f"🧠 {lvl} Quiz (5 Questions)")
@@ -538,8 +1860,7 @@ if st.session_state.file_text:
             if not st.session_state.quiz_card:
                 if st.button("🎲 Deal First Card"):
                     topic_card = random.choice(st.session_state.syllabus)
-                    prompt = f"""Create 1 MCQ for '{topic_card}'. JSON: {{"q":"...","opts":["A)...","B)...","C)...","D)..."],"ans":"A","exp":"..."}}"""
-                    st.session_state.quiz_card = get_groq_response(prompt, st.session_state.file_text, expect_json=True)
+                    st.session_state.quiz_card = next_game_card(topic_card, st.session_state.file_text, st.session_state.course_pack)
                     st.session_state.card_revealed = False
                     st.rerun()
             else:
@@ -555,8 +1876,7 @@ if st.session_state.file_text:
                     
                     # Immediately generate new one
                     topic_card = random.choice(st.session_state.syllabus)
-                    prompt = f"""Create 1 MCQ for '{topic_card}'. JSON: {{"q":"...","opts":["A)...","B)...","C)...","D)..."],"ans":"A","exp":"..."}}"""
-                    st.session_state.quiz_card = get_groq_response(prompt, st.session_state.file_text, expect_json=True)
+                    st.session_state.quiz_card = next_game_card(topic_card, st.session_state.file_text, st.session_state.course_pack)
                     st.rerun()
 
         with c_game:
@@ -593,28 +1913,16 @@ if st.session_state.file_text:
         if st.button("📄 Generate Exam"):
             with st.spinner("Setting Paper..."):
                 # STRICT PROMPT FOR ONLY MCQ (4 OPTIONS) AND FILL IN THE BLANKS
-                prompt = f"""
-                Create a strict JSON object with exactly 5 {q_type} questions based on the text. Difficulty: {diff}.
-                
-                JSON Structure must be EXACTLY:
-                {{
-                  "questions": [
-                    {{
-                      "id": 1,
-                      "type": "{q_type}",
-                      "text": "Question text here (For Fill in Blanks, use '_______' for the blank)",
-                      "options": ["A) ...", "B) ...", "C) ...", "D) ..."] (ONLY IF MCQ),
-                      "correct": "Answer here"
-                    }}
-                  ]
-                }}
-
-                IMPORTANT:
-                1. If type is MCQ, 'options' must be a list of 4 distinct strings.
-                2. If type is Fill in the Blanks, 'options' must be an empty list [].
-                3. Ensure valid JSON syntax (close all brackets/braces).
-                """
-                exam_data = get_groq_response(prompt, st.session_state.file_text, expect_json=True)
+                # The pack paper is served once per setting (or whenever no backend is up); later requests get a fresh one
+                paper_key = f"{q_type}|{diff}"
+                packed_paper = (st.session_state.course_pack or {}).get("exam_papers", {}).get(paper_key)
+                backend_ready = any(b.available() for b in BACKENDS.values())
+                if packed_paper and (paper_key not in st.session_state.served_exam_papers or not backend_ready):
+                    st.session_state.served_exam_papers.add(paper_key)
+                    exam_data = {"questions": [dict(q) for q in packed_paper]}
+                else:
+                    prompt = build_task("exam", q_type=q_type, difficulty=diff)
+                    exam_data = get_groq_response(prompt, st.session_state.file_text, expect_json=True, feature="exam")
                 if exam_data:
                     st.session_state.exam_paper = exam_data.get('questions', [])
                     st.session_state.exam_answers = {}
@@ -639,6 +1947,16 @@ if st.session_state.file_text:
                 
                 if st.form_submit_button("Submit Exam"):
                     score = 0
+                    graded = {}
+                    if q_type != "MCQ":
+                        # Fill in the blanks: grade the whole paper locally, escalate only unsure answers
+                        t0 = time.perf_counter()
+                        results = grade_blank_answers(
+                            st.session_state.exam_paper, st.session_state.exam_answers, st.session_state.file_text
+                        )
+                        grade_ms = (time.perf_counter() - t0) * 1000
+                        graded = {r["id"]: r for r in results}
+
                     for q in st.session_state.exam_paper:
                         ans = st.session_state.exam_answers.get(q['id'])
                         
@@ -649,15 +1967,15 @@ if st.session_state.file_text:
                             else:
                                 st.error(f"Q{q['id']}: Wrong. Correct: {q.get('correct')}")
                         else:
-                            # Fill in the blanks strict grading
-                            correct_val = q.get('correct', '').strip().lower()
-                            user_val = str(ans).strip().lower() if ans else ""
-                            if user_val == correct_val:
+                            if graded[q['id']]["correct"]:
                                 score += 1
                                 st.success(f"Q{q['id']}: Correct")
                             else:
                                 st.error(f"Q{q['id']}: Wrong. Correct: {q.get('correct')}")
                     
+                    if graded:
+                        escalated = sum(r["method"] == "llm" for r in graded.values())
+                        st.caption(f"Graded in {grade_ms:.0f} ms · {escalated} answer(s) checked by AI")
                     st.metric("Score", f"{score}/5")
                     if score == 5: st.session_state.xp += 100
 
@@ -668,16 +1986,11 @@ if st.session_state.file_text:
         st.subheader("⚡ 1-Hour Revision")
         if st.button("🔥 Generate Notes"):
             with st.spinner("Analysing Context & Summarizing..."):
-                prompt = """
-                Based ONLY on the provided context, create a revision sheet with:
-                1. 5 Key Definitions
-                2. 3 Common Misconceptions
-                3. A Formula/Date Cheat Sheet
-                4. A Golden Summary
-                Format in clean Markdown.
-                """
-                # expect_json=False because we want Markdown
-                rev = get_groq_response(prompt, st.session_state.file_text, expect_json=False)
+                rev = (st.session_state.course_pack or {}).get("revision")
+                if not rev:
+                    prompt = build_task("revision")
+                    # expect_json=False because we want Markdown
+                    rev = get_groq_response(prompt, st.session_state.file_text, expect_json=False, feature="revision")
                 if rev:
                     st.markdown(rev)
                 else:
@@ -693,25 +2006,54 @@ if st.session_state.file_text:
         c2.metric("Questions Done", st.session_state.total_qs)
         st.bar_chart({"Correct": st.session_state.correct_qs, "Wrong": st.session_state.total_qs - st.session_state.correct_qs})
 
+        with st.expander("🧪 Answer Grader: Accuracy vs Latency"):
+            st.caption(f"Accept ≥ {GRADE_ACCEPT_THRESHOLD} · Reject < {GRADE_REJECT_THRESHOLD} · in between escalates to AI")
+            if st.button("Run Grader Benchmark"):
+                st.table(benchmark_grader())
+
+        with st.expander("✂️ Prompt Token Budget: Savings per Feature"):
+            tokenizer = "tiktoken cl100k_base" if TIKTOKEN_AVAILABLE else "~4 chars/token estimate"
+            st.caption(f"Shared cached prefix: {count_tokens(SYSTEM_PROMPT)} system + ≤{CONTEXT_TOKEN_BUDGET} context tokens "
+                       f"for every feature · {tokenizer}")
+            st.table(prompt_savings_report(st.session_state.file_text))
+
+        with st.expander("📄 PDF Extraction: Pages per Second"):
+            st.caption(f"OCR {'enabled' if OCR_AVAILABLE else 'not installed'} · {OCR_WORKERS} worker(s) · {OCR_DPI} DPI")
+            if st.button("Run Extraction Benchmark"):
+                st.table(benchmark_pdf_extraction())
+            runs = _extraction_stats()["runs"]
+            if runs:
+                st.markdown("**Recent uploads** (first extraction of each file)")
+                st.table(runs[-10:])
+
+        with st.expander("🖥️ Model Backends: Throughput & Latency"):
+            st.caption("Routing: " + ", ".join(f"{f} → {' / '.join(order)}" for f, order in BACKEND_POLICY.items()))
+            report = backend_report()
+            if report:
+                st.table(report)
+            else:
+                st.info("No AI calls recorded yet.")
+
     # ---------------------------------------------------------
     # TAB 6: NEURAL CHAT
     # ---------------------------------------------------------
     with tabs[5]:
         st.subheader("💬 AI Tutor")
         for m in st.session_state.chat_history:
-            with st.chat_message(m["role"]): st.write(m["content"])
+            with st.chat_message(m["role"]): render_with_diagrams(m["content"], m.get("diagrams"))
         
         if p := st.chat_input("Ask a specific doubt..."):
             st.session_state.chat_history.append({"role": "user", "content": p})
             st.chat_message("user").write(p)
             
             # Simple direct prompt
-            r = get_groq_response(f"Answer this question strictly using the provided context: {p}", st.session_state.file_text, expect_json=False)
+            r = get_groq_response(build_task("chat", question=p), st.session_state.file_text, expect_json=False, feature="chat")
             
             if not r: r = "⚠️ Error: I could not reach the AI service. Please check your API key."
             
-            st.session_state.chat_history.append({"role": "assistant", "content": r})
-            st.chat_message("assistant").write(r)
+            diagrams = prepare_diagrams(r, st.session_state.file_text)
+            st.session_state.chat_history.append({"role": "assistant", "content": r, "diagrams": diagrams})
+            with st.chat_message("assistant"): render_with_diagrams(r, diagrams)
 
     # ---------------------------------------------------------
     # TAB 7: VIDEO STUDIO (UNTOUCHED)
@@ -731,7 +2073,7 @@ if st.session_state.file_text:
             
             if st.button("🎬 Render Video", type="primary"):
                 with st.spinner("1/4 Writing Script..."):
-                    content = get_groq_response(f"Explain '{v_topic}' for a video. Plain text only.", st.session_state.file_text)
+                    content = get_groq_response(build_task("video", topic=v_topic), st.session_state.file_text, feature="video")
                 
                 with st.spinner("2/4 Generating Audio..."):
                     audio_path = video_gen.create_audio_from_text(content, v_topic)
@@ -776,7 +2118,7 @@ if st.session_state.file_text:
         st.subheader("⚖️ Safety Audit")
         if st.button("🔍 Run Audit"):
             with st.spinner("Auditing..."):
-                audit = get_groq_response("Audit the provided content for any hallucinations or educational bias.", st.session_state.file_text, expect_json=False)
+                audit = get_groq_response(build_task("audit"), st.session_state.file_text, expect_json=False, feature="audit")
                 if audit:
                     st.markdown(audit)
                     st.success("Audit Complete")